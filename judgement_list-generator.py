@@ -1,9 +1,17 @@
+import numpy as np
 import pandas as pd
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+from elasticsearch.serializer import OrjsonSerializer
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import json
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 import logging
 import os
+from collections import Counter
+from itertools import islice
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,7 +24,9 @@ def connect_to_elasticsearch(host, api_key):
         es = Elasticsearch(
             hosts=[host],
             api_key=api_key,
-            request_timeout=60
+            request_timeout=60,
+            # orjson parses the large scroll responses several times faster than the stdlib json
+            serializer=OrjsonSerializer()
         )
 
         # Test the connection
@@ -31,185 +41,136 @@ def connect_to_elasticsearch(host, api_key):
         return None
 
 
-def fetch_ubi_data(es_client: Elasticsearch, queries_index: str, events_index: str,
-                   size: int = 10000) -> Tuple[List[Dict], List[Dict]]:
+def scan_index(es_client: Elasticsearch, index: str, query: Dict, source_includes: List[str],
+               batch_size: int = 1000) -> Iterator[Dict]:
     """
-    Fetch UBI queries and events data from Elasticsearch indices.
+    Stream the _source of every document matching a query using the scroll API.
 
     Args:
         es_client: Elasticsearch client
-        queries_index: Name of the UBI queries index
-        events_index: Name of the UBI events index
-        size: Maximum number of documents to fetch
+        index: Name of the index to scan
+        query: Query clause to filter documents
+        source_includes: _source fields to return, all others are dropped by Elasticsearch
+        batch_size: Number of documents to pull per scroll request
 
-    Returns:
-        Tuple of (queries_data, events_data)
+    Yields:
+        The filtered _source of each matching document
     """
-    logger.info(f"Fetching data from {queries_index} and {events_index}")
-
-    # Fetch queries with error handling
+    count = 0
     try:
-        queries_response = es_client.search(
-            index=queries_index,
-            body={
-                "query": {"match_all": {}},
-                "size": size
-            }
-        )
-        queries_data = [hit['_source'] for hit in queries_response['hits']['hits']]
-        logger.info(f"Fetched {len(queries_data)} queries")
+        # scan sorts by _doc for the cheapest scroll and clears the scroll context when exhausted
+        for hit in scan(es_client, index=index, query={"query": query, "_source": source_includes},
+                        size=batch_size, scroll='2m'):
+            count += 1
+            yield hit['_source']
 
     except Exception as e:
-        logger.error(f"Error fetching queries from {queries_index}: {e}")
+        logger.error(f"Error fetching documents from {index}: {e}")
         raise
 
-    # Fetch events (only click events for now) with error handling
-    try:
-        events_response = es_client.search(
-            index=events_index,
-            body={
-                "query": {
-                    "term": {"message_type.keyword": "CLICK_THROUGH"}
-                },
-                "size": size
-            }
-        )
-        events_data = [hit['_source'] for hit in events_response['hits']['hits']]
-        logger.info(f"Fetched {len(events_data)} click events")
+    logger.info(f"Fetched {count} documents from {index}")
 
-    except Exception as e:
-        logger.error(f"Error fetching events from {events_index}: {e}")
-        raise
 
-    logger.info(f"Data fetch completed successfully - Queries: {len(queries_data)}, Events: {len(events_data)}")
+def fetch_ubi_data(es_client: Elasticsearch, queries_index: str, events_index: str,
+                   batch_size: int = 1000) -> Tuple[Iterator[Dict], Iterator[Dict]]:
+    """
+    Fetch UBI queries and events data from Elasticsearch indices.
+
+    Documents are streamed lazily in batches, so nothing is requested until the
+    returned iterators are consumed.
+
+    Args:
+        es_client: Elasticsearch client
+        queries_index: Name of the UBI queries index
+        events_index: Name of the UBI events index
+        batch_size: Number of documents to pull per scroll request
+
+    Returns:
+        Tuple of (queries_data, events_data) iterators
+    """
+    logger.info(f"Fetching data from {queries_index} and {events_index}")
+
+    queries_data = scan_index(
+        es_client, queries_index,
+        {"match_all": {}},
+        ['query_id', 'user_query', 'query_response_object_ids'],
+        batch_size
+    )
+
+    # Fetch events (only click events for now), filtered server-side so every hit is a click
+    events_data = scan_index(
+        es_client, events_index,
+        {"bool": {"filter": [
+            {"term": {"message_type.keyword": "CLICK_THROUGH"}},
+            {"term": {"action_name.keyword": "click"}}
+        ]}},
+        ['query_id', 'event_attributes.object.object_id', 'event_attributes.object.position.ordinal'],
+        batch_size
+    )
 
     return queries_data, events_data
 
 
-def calculate_relevance_grade(document_id: str, clicks_data: Dict,
-                              query_response_ids: List[str], all_queries_data: List[Dict] = None,
-                              all_events_data: List[Dict] = None) -> float:
+def compute_coec_grades(imp_df: pd.DataFrame, position_impression_counts: np.ndarray,
+                        position_click_counts: np.ndarray, doc_click_counts: Dict[str, int]) -> pd.Series:
     """
-    Calculate COEC (Click Over Expected Clicks) relevance score for a document.
+    Calculate COEC (Click Over Expected Clicks) relevance scores for every document at once.
 
     Args:
-        document_id: ID of the document
-        clicks_data: Dictionary of clicked documents with their positions for current query
-        query_response_ids: List of document IDs shown in search results (ordered by position)
-        all_queries_data: All queries data for calculating position CTR averages
-        all_events_data: All events data for calculating position CTR averages
+        imp_df: One row (doc_id, pos) per first appearance of a document in a query response's top 10
+        position_impression_counts: Number of documents shown at each position, indexed by position (0-10)
+        position_click_counts: Number of clicks at each position, indexed by position (0-10)
+        doc_click_counts: Total actual clicks per document across all queries
 
     Returns:
-        COEC relevance score (continuous value, typically 0.0 to 5.0+)
+        Series of COEC relevance scores (continuous value, typically 0.0 to 5.0+) indexed by document ID
     """
-
-    # If no global data provided, fall back to simple position-based grading
-    if all_queries_data is None or all_events_data is None:
-        logger.warning("No global data provided, falling back to position-based grading")
-        # Simple fallback logic
-        if document_id in clicks_data:
-            position = clicks_data[document_id]['position']
-            if position > 3:
-                return 4.0
-            elif position >= 1 and position <= 3:
-                return 3.0
-        if document_id in query_response_ids:
-            position = query_response_ids.index(document_id) + 1
-            if position <= 5:
-                return 2.0
-            elif position >= 6 and position <= 10:
-                return 1.0
-        return 0.0
-
     # Calculate rank-aggregated click-through rates
-    position_ctr_averages = {}
-    position_impression_counts = {}
-    position_click_counts = {}
-
-    # Initialize counters
-    for pos in range(1, 11):  # Positions 1-10
-        position_impression_counts[pos] = 0
-        position_click_counts[pos] = 0
-
-    # Count impressions (every document shown contributes)
-    for query in all_queries_data:
-        for i, doc_id in enumerate(query['query_response_object_ids'][:10]):  # Top 10 positions
-            position = i + 1
-            position_impression_counts[position] += 1
-
-    # Count clicks by position
-    for event in all_events_data:
-        if event.get('action_name') == 'click':
-            position = event['event_attributes']['object']['position']['ordinal']
-            if position <= 10:
-                position_click_counts[position] += 1
-
-    # Calculate average CTR per position
-    for pos in range(1, 11):
-        if position_impression_counts[pos] > 0:
-            position_ctr_averages[pos] = position_click_counts[pos] / position_impression_counts[pos]
-        else:
-            position_ctr_averages[pos] = 0.0
+    ctr = np.divide(position_click_counts, position_impression_counts, out=np.zeros(11),
+                    where=position_impression_counts > 0)
 
-    # Calculate expected clicks for this specific document
-    expected_clicks = 0.0
+    # Expected clicks per document given the positions it appeared at
+    ectr = pd.Series(ctr[imp_df['pos'].to_numpy()], index=imp_df.index)
+    expected = ectr.groupby(imp_df['doc_id']).sum()
 
-    # Count how many times this document appeared at each position for any query
-    for query in all_queries_data:
-        if document_id in query['query_response_object_ids']:
-            position = query['query_response_object_ids'].index(document_id) + 1
-            if position <= 10:
-                expected_clicks += position_ctr_averages[position]
+    actual = pd.Series(doc_click_counts, dtype='float64')
+    actual = actual.reindex(expected.index, fill_value=0.0)
 
-    # Count total actual clicks for this document across all queries
-    actual_clicks = 0
-    for event in all_events_data:
-        if (event.get('action_name') == 'click' and
-                event['event_attributes']['object']['object_id'] == document_id):
-            actual_clicks += 1
+    grade = (actual / expected).where(expected > 0, 0.0)
+    grade.name = 'grade'
+    return grade
 
-    # Calculate COEC score
-    if expected_clicks > 0:
-        coec_score = actual_clicks / expected_clicks
-    else:
-        coec_score = 0.0
 
-    logger.debug(
-        f"Document {document_id}: {actual_clicks} clicks / {expected_clicks:.3f} expected = {coec_score:.3f} COEC")
+def position_map(document_ids: Iterable[str]) -> Dict[str, int]:
+    """Map each document ID to the 1-based position of its first appearance in a response."""
+    pos_by_doc = {}
+    for i, doc_id in enumerate(document_ids):
+        pos_by_doc.setdefault(doc_id, i + 1)
+    return pos_by_doc
 
-    return coec_score
 
-
-def process_ubi_data(queries_data: List[Dict], events_data: List[Dict]) -> pd.DataFrame:
+def process_ubi_data(queries_data: Iterable[Dict], events_data: Iterable[Dict]) -> pd.DataFrame:
     """
     Process UBI data and generate judgment list.
 
+    Both inputs are consumed in a single pass, so they can be the iterators
+    returned by fetch_ubi_data.
+
     Args:
-        queries_data: List of query documents from UBI queries index
-        events_data: List of event documents from UBI events index
+        queries_data: Query documents from UBI queries index
+        events_data: Click event documents from UBI events index, as returned by fetch_ubi_data
 
     Returns:
         DataFrame with judgment list (qid, docid, grade, keywords)
     """
     logger.info("Processing UBI data to generate judgment list")
 
-    # Group events by query_id
-    clicks_by_query = {}
-    for event in events_data:
-        query_id = event['query_id']
-        if query_id not in clicks_by_query:
-            clicks_by_query[query_id] = {}
-
-        # Extract clicked document info
-        object_id = event['event_attributes']['object']['object_id']
-        position = event['event_attributes']['object']['position']['ordinal']
-
-        clicks_by_query[query_id][object_id] = {
-            'position': position,
-            'timestamp': event['timestamp']
-        }
-
-    judgment_list = []
+    response_lengths = []
+    impression_doc_ids = []
+    impression_positions = []
+    qids = []
+    docids = []
+    queries = []
 
     # Process each query
     for query in queries_data:
@@ -217,22 +178,46 @@ def process_ubi_data(queries_data: List[Dict], events_data: List[Dict]) -> pd.Da
         user_query = query['user_query']
         document_ids = query['query_response_object_ids']
 
-        # Get clicks for this query
-        query_clicks = clicks_by_query.get(query_id, {})
+        # Every document shown in the top 10 positions counts as an impression
+        response_lengths.append(min(len(document_ids), 10))
+
+        # Only the first appearance of a document in a response counts towards its expected clicks
+        pos_by_doc = position_map(islice(document_ids, 10))
+        impression_doc_ids.extend(pos_by_doc.keys())
+        impression_positions.extend(pos_by_doc.values())
+
+        # Generate judgment for each document shown, one column at a time
+        qids.extend([query_id] * len(document_ids))
+        docids.extend(document_ids)
+        queries.extend([user_query] * len(document_ids))
+
+    # Collect click positions and count clicks by document
+    click_positions = []
+    doc_click_counts = Counter()
+    for event in events_data:
+        obj = event['event_attributes']['object']
+        click_positions.append(obj['position']['ordinal'])
+        doc_click_counts[obj['object_id']] += 1
+
+    # Position p got an impression from every response with at least p documents
+    response_lengths = np.asarray(response_lengths, dtype=np.int64)
+    position_impression_counts = np.bincount(response_lengths, minlength=11)[::-1].cumsum()[::-1]
 
-        # Generate judgment for each document shown
-        for doc_id in document_ids:
-            grade = calculate_relevance_grade(doc_id, query_clicks, document_ids,
-                                              queries_data, events_data)
+    click_positions = np.asarray(click_positions, dtype=np.int64)
+    click_positions = click_positions[(click_positions >= 1) & (click_positions <= 10)]
+    position_click_counts = np.bincount(click_positions, minlength=11)
 
-            judgment_list.append({
-                'qid': query_id,
-                'docid': doc_id,
-                'grade': grade,
-                'query': user_query
-            })
+    imp_df = pd.DataFrame({'doc_id': impression_doc_ids,
+                           'pos': np.asarray(impression_positions, dtype=np.int64)})
+    # Each document is graded exactly once, however many responses it appeared in
+    grade_by_doc = compute_coec_grades(imp_df, position_impression_counts,
+                                       position_click_counts, doc_click_counts)
 
-    df = pd.DataFrame(judgment_list)
+    # Documents never shown in the top 10 have no expected clicks and grade 0
+    docids = pd.Series(docids)
+    grades = docids.map(grade_by_doc).fillna(0.0).to_numpy()
+
+    df = pd.DataFrame({'qid': qids, 'docid': docids, 'grade': grades, 'query': queries})
     logger.info(f"Generated {len(df)} judgment entries for {df['qid'].nunique()} unique queries")
 
     return df
@@ -240,18 +225,57 @@ def process_ubi_data(queries_data: List[Dict], events_data: List[Dict]) -> pd.Da
 
 def generate_judgment_statistics(df: pd.DataFrame) -> Dict:
     """Generate statistics about the judgment list."""
+    # Scan each column once and derive every statistic from these
+    total_judgments = len(df)
+    unique_queries = df['qid'].nunique()
+    has_click = df['grade'].to_numpy() > 1
+    clicked_judgments = int(has_click.sum())
+
     stats = {
-        'total_judgments': len(df),
-        'unique_queries': df['qid'].nunique(),
+        'total_judgments': total_judgments,
+        'unique_queries': unique_queries,
         'unique_documents': df['docid'].nunique(),
         'grade_distribution': df['grade'].value_counts().to_dict(),
-        'avg_judgments_per_query': len(df) / df['qid'].nunique() if df['qid'].nunique() > 0 else 0,
-        'queries_with_clicks': len(df[df['grade'] > 1]['qid'].unique()),
-        'click_through_rate': len(df[df['grade'] > 1]) / len(df) if len(df) > 0 else 0
+        'avg_judgments_per_query': total_judgments / unique_queries if unique_queries > 0 else 0,
+        'queries_with_clicks': df['qid'][has_click].nunique(),
+        'click_through_rate': clicked_judgments / total_judgments if total_judgments > 0 else 0
     }
     return stats
 
 
+def save_judgment_list(df: pd.DataFrame, output_file: str):
+    """
+    Write the judgment list to a CSV file.
+
+    Uses pyarrow's vectorized CSV writer, formatted to match the output of
+    pandas' to_csv. Falls back to to_csv for values that need quoting and for
+    columns pyarrow cannot convert.
+
+    Args:
+        df: DataFrame with judgment list (qid, docid, grade, query)
+        output_file: Path of the CSV file to write
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        # Shortest round-trip repr like pandas, keeping the trailing .0 on whole numbers
+        grade = pc.cast(table['grade'], pa.string())
+        grade = pc.if_else(pc.match_substring_regex(grade, r'[.en]'), grade,
+                           pc.binary_join_element_wise(grade, '.0', ''))
+        table = table.set_column(table.schema.get_field_index('grade'), 'grade', grade)
+
+        with open(output_file, 'wb') as f:
+            # pyarrow always quotes the header, so write it unquoted like to_csv does
+            f.write((','.join(table.column_names) + '\n').encode())
+            pacsv.write_csv(table, f, pacsv.WriteOptions(include_header=False, quoting_style='none'))
+
+    except (pa.ArrowTypeError, pa.ArrowInvalid) as e:
+        # e.g. qids that are numbers in some UBI documents and strings in others,
+        # or queries containing commas or quotes
+        logger.warning(f"Cannot write judgment list with pyarrow ({e}), writing it with pandas")
+        df.to_csv(output_file, index=False)
+
+
 def main():
     """Main function to generate judgment list from UBI data."""
 
@@ -277,7 +301,7 @@ def main():
         logger.info(f"Judgment List Statistics: {json.dumps(stats, indent=2)}")
 
         # Save to CSV
-        judgment_df.to_csv(output_file, index=False)
+        save_judgment_list(judgment_df, output_file)
         logger.info(f"Judgment list saved to {output_file}")
 
         # Display sample